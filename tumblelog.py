@@ -14,24 +14,37 @@ from html import escape
 from operator import itemgetter
 from pathlib import Path
 from datetime import datetime
-from collections import defaultdict, deque
-from commonmark import commonmark
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+try:
+    import cmarkgfm
+
+    def commonmark(entry):
+        # Entries are the blog author's own content, so keep raw HTML
+        # just like the pure Python commonmark module does.
+        return cmarkgfm.markdown_to_html(
+            entry, cmarkgfm.Options.CMARK_OPT_UNSAFE)
+except ImportError:
+    from commonmark import commonmark
 
 VERSION = '1.0.3'
+ESCAPED_VERSION = escape(VERSION)
 
-RE_WEEK = re.compile(r'%V')
-RE_YEAR = re.compile(r'%Y')
+RE_DATE = re.compile(r'\d{4}-\d{2}-\d{2}')
 
-RE_TITLE      = re.compile(r'(?x) \[% \s* title      \s* %\]')
-RE_YEAR_RANGE = re.compile(r'(?x) \[% \s* year-range \s* %\]')
-RE_LABEL      = re.compile(r'(?x) \[% \s* label      \s* %\]')
-RE_CSS        = re.compile(r'(?x) \[% \s* css        \s* %\]')
-RE_NAME       = re.compile(r'(?x) \[% \s* name       \s* %\]')
-RE_AUTHOR     = re.compile(r'(?x) \[% \s* author     \s* %\]')
-RE_VERSION    = re.compile(r'(?x) \[% \s* version    \s* %\]')
-RE_FEED_URL   = re.compile(r'(?x) \[% \s* feed-url   \s* %\]')
-RE_BODY       = re.compile(r'(?x) \[% \s* body       \s* %\] \n')
-RE_ARCHIVE    = re.compile(r'(?x) \[% \s* archive    \s* %\] \n')
+RE_TEMPLATE = re.compile(
+    rb'(?x) \[% \s* ( title | year-range | label | css | name | author'
+    rb'             | version | feed-url ) \s* %\]'
+    rb'   | \[% \s* ( body | archive ) \s* %\] \n')
+
+
+# Render entries in parallel only if there is enough work to amortize
+# the cost of starting worker processes.
+MIN_PARALLEL_ENTRIES = 64
+
+entry_html_cache = {}
+created_dirs = set()
+page_queue = []
 
 
 class NoEntriesError(Exception):
@@ -41,26 +54,28 @@ class NoDateSpecified(Exception):
     """Thrown in case the first blog entry has no date"""
 
 
-def join_year_week(year, week):
+def join_year_week(year: int, week: int) -> str:
     return f'{year:04d}-{week:02d}'
 
-def split_year_week(year_week):
+def split_year_week(year_week: str) -> list:
     return year_week.split('-')
 
-def split_date(date):
+def split_date(date: str) -> list:
     return date.split('-')
 
-def parse_date(str):
-    return datetime.strptime(str, '%Y-%m-%d')
+def parse_date(date: str) -> datetime:
+    # The format is known to be YYYY-MM-DD; constructing the datetime
+    # directly is several times faster than strptime.
+    return datetime(int(date[0:4]), int(date[5:7]), int(date[8:10]))
 
-def year_week_label(format, year, week):
-    str = RE_WEEK.sub(week, format)
-    str = RE_YEAR.sub(year, str)
-    return str
+def year_week_label(label_format: str, year: str, week: str) -> str:
+    return label_format.replace('%V', week).replace('%Y', year)
 
-def get_year_week(date):
-    dt = parse_date(date)
-    return join_year_week(*dt.isocalendar()[0:2])
+def ensure_dir(directory):
+    key = str(directory)
+    if key not in created_dirs:
+        Path(directory).mkdir(parents=True, exist_ok=True)
+        created_dirs.add(key)
 
 def read_tumblelog_entries(filename):
     with open(filename, encoding='utf8') as f:
@@ -70,20 +85,19 @@ def read_tumblelog_entries(filename):
 
     return entries
 
-def collect_days(entries):
-    pattern = re.compile(r'(\d{4}-\d{2}-\d{2})(.*?)\n(.*)', flags=re.DOTALL)
+def collect_days(entries, config):
     date = None
-    days = deque()
+    days = []
     for entry in entries:
-        match = pattern.match(entry)
-        if match:
-            date = match.group(1)
+        newline = entry.find('\n')
+        if newline >= 0 and RE_DATE.match(entry):
+            date = entry[:10]
             days.append({
                 'date': date,
-                'title': match.group(2).strip(),
+                'title': entry[10:newline].strip(),
                 'entries': []
             })
-            entry = match.group(3)
+            entry = entry[newline + 1:]
         if date is None:
             raise NoDateSpecified('No date specified for first tumblelog entry')
 
@@ -91,283 +105,344 @@ def collect_days(entries):
 
     days = sorted(days, key=itemgetter('date'), reverse=True)
 
+    for day in days:
+        dt = parse_date(day['date'])
+        iso = dt.isocalendar()
+        day['ymd'] = split_date(day['date'])
+        day['iso'] = (iso.year, iso.week)
+        day['year-week'] = join_year_week(*day['iso'])
+        day['date-label'] = dt.strftime(config['date-format'])
+        day['date-html'] = {
+            path: html_for_date(day, path) for path in ('archive', '../..')
+        }
+        day['link-html'] = html_link_for_day(day)
+
     return days
 
 def create_archive(days):
 
     seen = {}
-    archive = defaultdict(deque)
+    archive = defaultdict(list)
     for day in days:
-        dt = parse_date(day['date'])
-        year, week = dt.isocalendar()[0:2]
-        year_week = join_year_week(year, week)
+        year, week = day['iso']
+        year_week = day['year-week']
         if year_week not in seen:
-            archive[f'{year:04d}'].appendleft(f'{week:02d}')
+            archive[f'{year:04d}'].append(f'{week:02d}')
             seen[year_week] = 1
 
     return archive
 
-def html_link_for_day(day, config):
+def html_link_for_day(day):
 
     title = escape(day['title'])
-    label = escape(parse_date(day['date']).strftime(config['date-format']))
+    label = escape(day['date-label'])
     if not title:
         title = label
 
-    year, month, day_number = split_date(day['date'])
+    year, month, day_number = day['ymd']
     uri = f'../../{year}/{month}/{day_number}.html'
 
     return f'<a href="{uri}" title="{label}">{title}</a>'
 
-def html_for_next_prev(days, index, config):
+def html_for_next_prev(days, index):
 
     length = len(days)
     if length == 1:
         return ''
 
-    html = '<nav class="tl-next-prev">\n'
+    parts = ['<nav class="tl-next-prev">\n']
 
     if index:
-        html += ''.join([
+        parts.extend([
             '  <div class="next">',
-            html_link_for_day(days[index - 1], config),
+            days[index - 1]['link-html'],
             '</div>',
             '<div class="tl-right-arrow">\u2192</div>\n'
         ])
 
     if index < length - 1:
-        html += ''.join([
+        parts.extend([
             '  <div class="tl-left-arrow">\u2190</div>',
             '<div class="prev">',
-            html_link_for_day(days[index + 1], config),
+            days[index + 1]['link-html'],
             '</div>\n'
         ])
 
-    html += '</nav>\n'
+    parts.append('</nav>\n')
 
-    return html
+    return ''.join(parts)
 
-def html_for_archive(archive, current_year_week, path, label_format):
-    html = '<nav>\n  <dl class="tl-archive">\n'
-    for year in sorted(archive.keys(), reverse=True):
-        html += f'    <dt>{year}</dt>\n    <dd>\n      <ul>\n'
-        for week in archive[year]:
-            year_week = join_year_week(int(year), int(week))
-            if current_year_week is not None and year_week == current_year_week:
-                html += f'        <li class="tl-self">{week}</li>\n'
-            else:
-                title = escape(year_week_label(label_format, year, week))
-                uri = f'{path}/{year}/week/{week}.html'
-                html += ''.join([
-                    '        <li>',
-                    f'<a href="{uri}" title="{title}">{week}</a></li>\n'
-                ])
-        html += '      </ul>\n    </dd>\n'
-    html += '  </dl>\n</nav>\n'
-
-    return html
+def html_for_archive(archive, years, path, label_format):
+    """Render the archive once; return the HTML and, per year-week, the
+    list item pair needed to mark that week as the current one."""
 
-def html_for_date(date, date_format, path):
-    year, month, day = date.split('-')
-    uri = f'{path}/{year}/{month}/{day}.html'
+    week_items = {}
+    parts = ['<nav>\n  <dl class="tl-archive">\n']
+    for year in years:
+        parts.append(f'    <dt>{year}</dt>\n    <dd>\n      <ul>\n')
+        for week in reversed(archive[year]):
+            year_week = join_year_week(int(year), int(week))
+            title = escape(year_week_label(label_format, year, week))
+            uri = f'{path}/{year}/week/{week}.html'
+            item = ('        <li>'
+                    f'<a href="{uri}" title="{title}">{week}</a></li>\n')
+            week_items[year_week] = (
+                item, f'        <li class="tl-self">{week}</li>\n')
+            parts.append(item)
+        parts.append('      </ul>\n    </dd>\n')
+    parts.append('  </dl>\n</nav>\n')
+
+    return ''.join(parts), week_items
+
+def html_for_week_page_archive(archive_html, current_year_week):
+    html, week_items = archive_html
+    item, self_item = week_items[current_year_week]
+    return html.replace(item, self_item, 1)
+
+def html_for_date(day, path):
+    year, month, day_number = day['ymd']
+    uri = f'{path}/{year}/{month}/{day_number}.html'
 
     return ''.join([
-        f'<time class="tl-date" datetime="{date}"><a href="{uri}">',
-        parse_date(date).strftime(date_format),
+        f'<time class="tl-date" datetime="{day["date"]}"><a href="{uri}">',
+        day['date-label'],
         '</a></time>\n'
     ])
 
 def html_for_entry(entry):
-    return ''.join([
-        '<article>\n',
-        commonmark(entry),
-        '</article>\n'
-    ])
+    html = entry_html_cache.get(entry)
+    if html is None:
+        html = ''.join(['<article>\n', commonmark(entry), '</article>\n'])
+        entry_html_cache[entry] = html
+    return html
+
+def render_entries(days):
+    entries = list(dict.fromkeys(
+        entry for day in days for entry in day['entries']))
+
+    if len(entries) < MIN_PARALLEL_ENTRIES:
+        rendered = map(commonmark, entries)
+    else:
+        with ProcessPoolExecutor() as executor:
+            rendered = list(executor.map(commonmark, entries, chunksize=16))
+
+    for entry, html in zip(entries, rendered):
+        entry_html_cache[entry] = ''.join(
+            ['<article>\n', html, '</article>\n'])
 
 def label_and_title(day, config):
-    label = parse_date(day['date']).strftime(config['date-format'])
+    # The separator contains nothing to escape, so joining escaped
+    # parts gives an already escaped title.
+    label = day['date-label']
     title = day['title']
     if title:
-        title = ' - '.join([title, config['name']])
+        title = ' - '.join([escape(title), config['name-escaped']])
     else:
-        title = ' - '.join([config['name'], label])
+        title = ' - '.join([config['name-escaped'], escape(label)])
 
     return label, title
 
-def create_page(path, title, body_html, archive_html, config,
+def create_page(path, title_html, body_html, archive_html, config,
                 label, min_year, max_year):
     if min_year == max_year:
         year_range = min_year
     else:
-        year_range = f'{min-year}\u2013{max_year}'
+        year_range = f'{min_year}\u2013{max_year}'
 
     slashes = path.count('/')
     css = ''.join(['../' * slashes, config['css']])
 
-    html = config['template']
-    html = RE_TITLE.sub(escape(title), html)
-    html = RE_YEAR_RANGE.sub(escape(year_range), html)
-    html = RE_LABEL.sub(escape(label), html)
-    html = RE_CSS.sub(escape(css), html)
-    html = RE_NAME.sub(escape(config['name']), html)
-    html = RE_AUTHOR.sub(escape(config['author']), html)
-    html = RE_VERSION.sub(escape(VERSION), html)
-    html = RE_FEED_URL.sub(escape(config['feed-url']), html)
-    html = RE_BODY.sub(lambda x: body_html, html, count=1)
-    html = RE_ARCHIVE.sub(archive_html, html)
-
-    Path(config['output-dir']).joinpath(path).write_text(
-        html, encoding='utf-8')
+    values = {
+        b'title':      title_html.encode('utf-8'),
+        b'year-range': escape(year_range).encode('utf-8'),
+        b'label':      escape(label).encode('utf-8'),
+        b'css':        escape(css).encode('utf-8'),
+        b'body':       body_html.encode('utf-8'),
+        b'archive':    archive_html.encode('utf-8'),
+        **config['page-values'],
+    }
+    html = RE_TEMPLATE.sub(
+        lambda match: values[match.group(1) or match.group(2)],
+        config['template']
+    )
+
+    page_queue.append((path, html))
 
-    if not config['quiet']:
-        print(f"Created '{path}'")
+def write_pages(config):
+    output_dir = Path(config['output-dir'])
+    with ThreadPoolExecutor() as executor:
+        futures = [
+            executor.submit(output_dir.joinpath(path).write_bytes, html)
+            for path, html in page_queue
+        ]
+        for (path, _), future in zip(page_queue, futures):
+            future.result()
+            if not config['quiet']:
+                print(f"Created '{path}'")
 
-def create_index(days, archive, config, min_year, max_year):
-    body_html = ''
+    page_queue.clear()
+
+def create_index(days, archive, years, config, min_year, max_year):
+    body_parts = []
     todo = config['days']
 
     for day in days:
-        body_html += html_for_date(
-            day['date'], config['date-format'], 'archive'
-        )
+        body_parts.append(day['date-html']['archive'])
         for entry in day['entries']:
-            body_html += html_for_entry(entry)
+            body_parts.append(html_for_entry(entry))
         todo -= 1
         if not todo:
             break
 
-    archive_html = html_for_archive(
-        archive, None, 'archive', config['label-format'])
+    archive_html, _ = html_for_archive(
+        archive, years, 'archive', config['label-format'])
 
     label = 'home'
-    title = ' - '.join([config['name'], label])
+    title = ' - '.join([config['name-escaped'], label])
 
-    Path(config['output-dir']).mkdir(parents=True, exist_ok=True)
+    ensure_dir(config['output-dir'])
     create_page(
-        'index.html', title, body_html, archive_html, config,
+        'index.html', title, ''.join(body_parts), archive_html, config,
         label, min_year, max_year
     )
 
-def create_week_page(year_week, body_html, archive, config, min_year, max_year):
+def create_week_page(year_week, body_html, archive_html, config,
+                     min_year, max_year):
 
-    archive_html = html_for_archive(
-        archive, year_week, '../..', config['label-format'])
+    page_archive_html = html_for_week_page_archive(archive_html, year_week)
 
     year, week = split_year_week(year_week)
     label = year_week_label(config['label-format'], year, week)
-    title = ' - '.join([config['name'], label])
+    title = ' - '.join([config['name-escaped'], escape(label)])
 
     path = f'archive/{year}/week'
-    Path(config['output-dir']).joinpath(path).mkdir(
-        parents=True, exist_ok=True)
+    ensure_dir(Path(config['output-dir']).joinpath(path))
     create_page(
         path + f'/{week}.html',
-        title, body_html, archive_html, config,
+        title, body_html, page_archive_html, config,
         label, min_year, max_year
     )
 
-def create_day_and_week_pages(days, archive, config, min_year, max_year):
+def create_day_and_week_pages(days, archive, years, config,
+                              min_year, max_year):
 
-    week_body_html = ''
-    current_year_week = get_year_week(days[0]['date'])
-    day_archive_html = html_for_archive(
-        archive, None, '../..', config['label-format'])
+    week_body_parts = []
+    current_year_week = days[0]['year-week']
+    archive_html = html_for_archive(
+        archive, years, '../..', config['label-format'])
+    day_archive_html = archive_html[0]
     index = 0
     for day in days:
-        day_body_html = html_for_date(
-            day['date'], config['date-format'], '../..'
-        )
+        day_body_parts = [day['date-html']['../..']]
         for entry in day['entries']:
-            day_body_html += html_for_entry(entry)
-            label, title = label_and_title(day, config)
-            year, month, day_number = split_date(day['date'])
-            next_prev_html = html_for_next_prev(days, index, config)
+            day_body_parts.append(html_for_entry(entry))
+
+        label, title = label_and_title(day, config)
+        year, month, day_number = day['ymd']
+        next_prev_html = html_for_next_prev(days, index)
 
         path = f'archive/{year}/{month}'
-        Path(config['output-dir']).joinpath(path).mkdir(
-            parents=True, exist_ok=True)
+        ensure_dir(Path(config['output-dir']).joinpath(path))
         create_page(
             path + f'/{day_number}.html',
-            title, day_body_html + next_prev_html, day_archive_html,
+            title, ''.join(day_body_parts) + next_prev_html,
+            day_archive_html,
             config,
             label, min_year, max_year
         )
 
-        year_week = get_year_week(day['date'])
+        year_week = day['year-week']
         if year_week == current_year_week:
-            week_body_html += day_body_html
+            week_body_parts.extend(day_body_parts)
         else:
             create_week_page(
-                current_year_week, week_body_html, archive, config,
-                min_year, max_year
+                current_year_week, ''.join(week_body_parts), archive_html,
+                config, min_year, max_year
             )
             current_year_week = year_week
-            week_body_html = day_body_html
+            week_body_parts = list(day_body_parts)
 
         index += 1
 
     create_week_page(
-        year_week, week_body_html, archive, config,
+        year_week, ''.join(week_body_parts), archive_html, config,
         min_year, max_year
     )
 
 def create_json_feed(days, config):
-    items = []
     todo = config['days']
 
-    for day in days:
-        html = ''
-        for entry in day['entries']:
-            html += html_for_entry(entry)
-
-        year, month, day_number = split_date(day['date'])
-        url = urllib.parse.urljoin(
-            config['blog-url'], f'archive/{year}/{month}/{day_number}.html')
-        title = day['title']
-        if not title:
-            title = parse_date(day['date']).strftime(config['date-format'])
-
-        items.append({
-            'id':    url,
-            'url':   url,
-            'title': title,
-            'content_html':   html,
-            'date_published': day['date']
-        })
-        todo -= 1
-        if not todo:
-            break
-
-    feed = {
-        'version':       'https://jsonfeed.org/version/1',
-        'title':         config['name'],
-        'home_page_url': config['blog-url'],
-        'feed_url':      config['feed-url'],
-        'author': {
-            'name': config['author']
-        },
-        'items': items
-    }
     path = config['feed-path']
     p = Path(config['output-dir']).joinpath(path)
     with p.open(mode='w', encoding='utf-8') as f:
-        json.dump(feed, f, indent=3, ensure_ascii=False, sort_keys=True,
-                  separators=(',', ': '))
-        print('', file=f)
+        # Stream one item at a time instead of building the whole feed
+        # and its serialization in memory; keys are written in sorted
+        # order, so the output is identical to a sort_keys json.dump.
+        f.write('{\n')
+        f.write(f'   "author": {{\n'
+                f'      "name": {json.dumps(config["author"], ensure_ascii=False)}\n'
+                f'   }},\n')
+        f.write(f'   "feed_url": '
+                f'{json.dumps(config["feed-url"], ensure_ascii=False)},\n')
+        f.write(f'   "home_page_url": '
+                f'{json.dumps(config["blog-url"], ensure_ascii=False)},\n')
+        f.write('   "items": [\n')
+
+        first = True
+        for day in days:
+            html = ''.join(html_for_entry(entry) for entry in day['entries'])
+
+            year, month, day_number = day['ymd']
+            url = urllib.parse.urljoin(
+                config['blog-url'],
+                f'archive/{year}/{month}/{day_number}.html')
+            title = day['title']
+            if not title:
+                title = day['date-label']
+
+            item = {
+                'content_html':   html,
+                'date_published': day['date'],
+                'id':    url,
+                'title': title,
+                'url':   url
+            }
+            if not first:
+                f.write(',\n')
+            first = False
+            text = json.dumps(item, indent=3, ensure_ascii=False,
+                              separators=(',', ': '))
+            f.write('      ' + text.replace('\n', '\n      '))
+
+            todo -= 1
+            if not todo:
+                break
+
+        f.write('\n   ],\n')
+        f.write(f'   "title": '
+                f'{json.dumps(config["name"], ensure_ascii=False)},\n')
+        f.write('   "version": "https://jsonfeed.org/version/1"\n')
+        f.write('}\n')
 
     if not config['quiet']:
         print(f"Created '{path}'")
 
 def create_blog(config):
-    days = collect_days(read_tumblelog_entries(config['filename']))
+    days = collect_days(read_tumblelog_entries(config['filename']), config)
 
-    max_year = (split_date(days[0]['date']))[0]
-    min_year = (split_date(days[-1]['date']))[0]
+    max_year = days[0]['ymd'][0]
+    min_year = days[-1]['ymd'][0]
 
     archive = create_archive(days)
+    years = sorted(archive.keys(), reverse=True)
+
+    render_entries(days)
+
+    create_index(days, archive, years, config, min_year, max_year)
+    create_day_and_week_pages(days, archive, years, config,
+                              min_year, max_year)
 
-    create_index(days, archive, config, min_year, max_year)
-    create_day_and_week_pages(days, archive, config, min_year, max_year)
+    write_pages(config)
 
     create_json_feed(days, config)
 
@@ -448,13 +523,26 @@ def get_config():
         print('Additional arguments have been skipped', file=sys.stderr)
 
     config['filename'] = args[0]
+    # The template is substituted and written as UTF-8 bytes, so encode
+    # it once here instead of re-encoding every rendered page.
     with open(config['template-filename'], encoding='utf-8') as f:
-        config['template'] = f.read()
+        config['template'] = f.read().encode('utf-8')
 
     config['feed-path'] = 'feed.json'
     config['feed-url'] = urllib.parse.urljoin(
         config['blog-url'], config['feed-path'])
 
+    config['name-escaped'] = escape(config['name'])
+    config['author-escaped'] = escape(config['author'])
+    config['feed-url-escaped'] = escape(config['feed-url'])
+    config['page-values'] = {
+        b'name':     config['name-escaped'].encode('utf-8'),
+        b'author':   config['author-escaped'].encode('utf-8'),
+        b'version':  ESCAPED_VERSION.encode('utf-8'),
+        b'feed-url': config['feed-url-escaped'].encode('utf-8'),
+    }
+
     return config
 
-create_blog(get_config())
+if __name__ == '__main__':
+    create_blog(get_config())